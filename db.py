@@ -5,17 +5,30 @@ class DbManagement:
     def __init__(self, db_name: str="test.db"):
         self.db_name = db_name
         self.connection = self.start_connection()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
         self.cursor = self.connection.cursor()
 
     def start_connection(self):
         return sqlite3.connect(self.db_name)
 
-    def execute_query(self, query: str = ""):
+    def execute_query(self, query: str = "", params: tuple = ()):
         if query == "":
             return None
-        self.cursor.execute(query)
+        self.cursor.execute(query, params)
+        rows = self.cursor.fetchall()
         self.connection.commit()
+        return rows
 
+    def executemany(self, query: str, rows, before: tuple = ()):
+        # un solo commit per tutte le righe; before=(query, params) gira nella stessa transazione
+        with self.connection:
+            if before:
+                self.cursor.execute(*before)
+            self.cursor.executemany(query, rows)
+
+    def columns(self, table: str):
+        return [r[1] for r in self.execute_query(f"PRAGMA table_info({table})")]
 
     def close_connection(self):
         self.connection.close()
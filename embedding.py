@@ -1,42 +1,238 @@
-import json
+import hashlib
+import logging
+import os
+import re
+from functools import lru_cache
+
+from thread_limits import NUM_THREADS  # prima di faiss/numpy/torch
 
 import faiss
 import numpy as np
+import orjson
+import torch
 from sentence_transformers import SentenceTransformer
-from typing import Dict, List
+from typing import Dict, List, Optional
+
+# ============ CONFIG ============
+INDEX_TYPES = ("flat", "sq8", "hnsw", "ivfpq")
+TRAINED_INDEX_TYPES = ("sq8", "ivfpq")  # addestrati sul primo batch passato ad add_texts
+IVFPQ_FACTORY = "OPQ32,IVF1024,PQ32"
+IVFPQ_NLIST = 1024
+IVFPQ_MIN_TRAIN = 30 * IVFPQ_NLIST  # vettori minimi per addestrare IVF
+IVFPQ_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+GPU_MIN_BATCH = 32  # sotto questa soglia la ricerca su GPU non conviene
+# =================================
+
+log = logging.getLogger("doc-analyzer")
+
+faiss.omp_set_num_threads(NUM_THREADS)
+torch.set_num_threads(NUM_THREADS)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass  # già impostato (o lavoro parallelo già avviato) in questo processo
+
+_NON_WORD = re.compile(r"\W+")
+
+
+def text_key(text: str, model_name: str = "") -> str:
+    """
+    Chiave della cache embedding: hash del testo normalizzato (minuscole,
+    solo caratteri alfanumerici, spazi compressi), così differenze di
+    spaziatura/punteggiatura tra due run riusano lo stesso embedding.
+    """
+    norm = _NON_WORD.sub(" ", text.lower()).strip()
+    return hashlib.blake2b(f"{model_name}|{norm}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=4)
+def _get_model(model_name: str, device: str) -> SentenceTransformer:
+    """Encoder condiviso tra le istanze di VectorIndex (caricato una volta sola)."""
+    return SentenceTransformer(model_name, device=device)
+
 
 class VectorIndex:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 device: Optional[str] = None, batch_size: int = 64,
+                 index_type: str = "flat", use_gpu: bool = False,
+                 emb_cache_path: Optional[str] = None):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Tipo di indice non valido: {index_type}")
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_size = batch_size
+        self.index_type = index_type
+        self.use_gpu = use_gpu and faiss.get_num_gpus() > 0
+        if use_gpu and not self.use_gpu:
+            log.warning("Nessuna GPU disponibile per FAISS: uso la CPU")
+        self.model_name = model_name
+        self.model = _get_model(model_name, self.device)
+        self.emb_cache_path = emb_cache_path
+        self.emb_cache: Optional[Dict[str, np.ndarray]] = None  # text_key -> embedding normalizzato
+        if emb_cache_path is not None:
+            self.emb_cache = self._load_emb_cache(emb_cache_path)
         self.index = None
+        self.gpu_index = None  # copia su GPU di self.index (solo se use_gpu)
+        self._cpu_stale = False  # True se gpu_index contiene vettori non ancora in self.index
         self.meta = []  # metadati paralleli alle righe dell’indice
 
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        emb = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                show_progress_bar=False)
+        emb = np.ascontiguousarray(emb, dtype="float32")
+        faiss.normalize_L2(emb)  # in-place: prodotto interno = coseno
+        return emb
+
+    def _encode_cached(self, texts: List[str]) -> np.ndarray:
+        """Come _encode, ma riusa gli embedding già calcolati per testi (quasi) identici."""
+        if self.emb_cache is None:
+            return self._encode(texts)
+        keys = [text_key(t, self.model_name) for t in texts]
+        missing = {k: t for k, t in zip(keys, texts) if k not in self.emb_cache}
+        if missing:
+            self.emb_cache.update(zip(missing.keys(), self._encode(list(missing.values()))))
+        log.info(f"Embedding in cache: {len(texts) - len(missing)}/{len(texts)}")
+        return np.stack([self.emb_cache[k] for k in keys])
+
+    @staticmethod
+    def _load_emb_cache(path: str) -> Dict[str, np.ndarray]:
+        if not os.path.exists(path):
+            return {}
+        with np.load(path) as data:
+            return dict(zip(data["keys"].tolist(), data["emb"]))
+
+    def _save_emb_cache(self):
+        if not self.emb_cache:
+            return
+        with open(self.emb_cache_path, "wb") as f:
+            np.savez(f, keys=np.array(list(self.emb_cache.keys())),
+                     emb=np.stack(list(self.emb_cache.values())))
+
+    def _build_index(self, dim: int):
+        """
+        flat  = ricerca esatta (IndexFlatIP), adatto a pochi documenti
+        sq8   = ricerca esatta su vettori quantizzati int8 (4x meno memoria)
+        hnsw  = grafo HNSW, sub-lineare, per corpora medi
+        ivfpq = OPQ+IVF+PQ compresso, per corpora grandi (richiede train)
+        Tutti usano il prodotto interno = coseno su vettori normalizzati.
+        """
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            return index
+        if self.index_type == "sq8":
+            return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        if self.index_type == "ivfpq":
+            return faiss.index_factory(dim, IVFPQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexFlatIP(dim)  # cosine (con normalized=True)
+
+    def train(self, sample: List[str]):
+        """Addestra l'indice (solo ivfpq) su un campione rappresentativo di testi."""
+        emb = self._encode(sample)
+        if self.index is None:
+            self.index = self._build_index(emb.shape[1])
+        if not self.index.is_trained:
+            self.index.train(emb)
+
+    @property
+    def needs_training(self) -> bool:
+        """
+        True se l'indice non è ancora addestrato: il prossimo add_texts
+        (o train) lo addestra, quindi conviene passargli tutto il corpus.
+        """
+        if self.index is not None:
+            return not self.index.is_trained
+        return self.index_type in TRAINED_INDEX_TYPES
+
     def add_texts(self, texts: List[str], metadatas: List[Dict]):
-        emb = self.model.encode(texts, normalize_embeddings=True)
-        emb = np.asarray(emb, dtype="float32")
+        emb = self._encode_cached(texts)
         if self.index is None:
-            self.index = faiss.IndexFlatIP(emb.shape[1])  # cosine (con normalized=True)
-        self.index.add(emb)
+            if self.index_type == "ivfpq" and len(emb) < IVFPQ_MIN_TRAIN:
+                log.warning(f"Solo {len(emb)} vettori (< {IVFPQ_MIN_TRAIN}) per addestrare IVFPQ: "
+                            "uso IndexFlatIP. Chiamare train() con un campione più ampio.")
+                self.index = faiss.IndexFlatIP(emb.shape[1])
+            else:
+                self.index = self._build_index(emb.shape[1])
+        if not self.index.is_trained:
+            self.index.train(emb)
+        if self.use_gpu and self.gpu_index is None:
+            self._to_gpu()
+        if self.gpu_index is not None:
+            self.gpu_index.add(emb)
+            self._cpu_stale = True
+        else:
+            self.index.add(emb)
         self.meta.extend(metadatas)
 
+    def _to_gpu(self):
+        """Copia l'indice (già addestrato) su tutte le GPU disponibili."""
+        try:
+            self.gpu_index = faiss.index_cpu_to_all_gpus(self.index)
+            if self.index_type == "ivfpq" and not isinstance(self.index, faiss.IndexFlat):
+                faiss.GpuParameterSpace().set_index_parameter(self.gpu_index, "nprobe", IVFPQ_NPROBE)
+        except RuntimeError as e:
+            log.warning(f"Indice {type(self.index).__name__} non supportato su GPU ({e}): uso la CPU")
+            self.use_gpu = False
+            self.gpu_index = None
+
+    def _cpu_index(self):
+        """Ritorna l'indice su CPU, riallineandolo alla copia GPU se necessario."""
+        if self._cpu_stale:
+            self.index = faiss.index_gpu_to_cpu(self.gpu_index)
+            self._cpu_stale = False
+        return self.index
+
+    @staticmethod
+    def _set_search_params(index):
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+            return
+        try:
+            faiss.extract_index_ivf(index).nprobe = IVFPQ_NPROBE
+        except RuntimeError:
+            pass  # indice non IVF (o su GPU)
+
+    def search_batch(self, queries: List[str], k: int = 5) -> List[List[Dict]]:
+        """
+        Ricerca di più query con una sola chiamata FAISS (parallela su OpenMP).
+        Su GPU solo per batch >= GPU_MIN_BATCH, altrimenti resta su CPU.
+        Ritorna una lista di risultati per ogni query, nello stesso ordine.
+        """
+        Q = self._encode(queries)
+        if self.gpu_index is not None and len(queries) >= GPU_MIN_BATCH:
+            index = self.gpu_index
+        else:
+            index = self._cpu_index()
+        self._set_search_params(index)
+        D, I = index.search(Q, k)
+        results = []
+        for scores, idxs in zip(D, I):
+            out = []
+            for score, idx in zip(scores, idxs):
+                if idx == -1:
+                    continue
+                item = dict(self.meta[idx])
+                item["score"] = float(score)
+                out.append(item)
+            results.append(out)
+        return results
+
     def search(self, query: str, k: int = 5) -> List[Dict]:
-        q = self.model.encode([query], normalize_embeddings=True).astype("float32")
-        D, I = self.index.search(q, k)
-        out = []
-        for score, idx in zip(D[0], I[0]):
-            if idx == -1:
-                continue
-            item = dict(self.meta[idx])
-            item["score"] = float(score)
-            out.append(item)
-        return out
+        return self.search_batch([query], k)[0]
 
     def save(self, path_idx: str, path_meta: str):
-        faiss.write_index(self.index, path_idx)
-        with open(path_meta, "w", encoding="utf-8") as f:
-            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        faiss.write_index(self._cpu_index(), path_idx)
+        with open(path_meta, "wb") as f:
+            f.write(orjson.dumps(self.meta, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        self._save_emb_cache()
 
     def load(self, path_idx: str, path_meta: str):
         self.index = faiss.read_index(path_idx)
-        with open(path_meta, "r", encoding="utf-8") as f:
-            self.meta = json.load(f)
+        self.gpu_index = None
+        self._cpu_stale = False
+        if self.use_gpu:
+            self._to_gpu()
+        with open(path_meta, "rb") as f:
+            self.meta = orjson.loads(f.read())
@@ -1,35 +1,67 @@
 import re
-import json
 import base64
-import time
+import asyncio
+import hashlib
 import logging
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from thread_limits import NUM_THREADS  # limiti OpenMP/BLAS: prima di numpy/faiss/torch
 
 import fitz
+import numpy as np
 import ollama
+import orjson
 import pytesseract
-from pdf2image import convert_from_path
-from PIL import Image, ImageOps, ImageFilter
+from PIL import Image
+
+from db import DbManagement
+from ocr import DEFAULT_TESSERACT, OCR_LANG, init_ocr_worker, ocr_image_bytes, set_tesseract
 
-from embedding import VectorIndex
+# embedding (torch, faiss, sentence-transformers) è importato solo dove serve:
+# con spawn (Windows) ogni processo OCR reimporta questo modulo.
+if TYPE_CHECKING:
+    from embedding import VectorIndex
 
 # ============ CONFIG ============
-DEFAULT_TESSERACT = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 DEFAULT_MODEL_VL = "qwen2.5vl"  # modello vision-language
-OCR_LANG = "eng+ita"  # personalizzabile da CLI
 DPI = 300
+OCR_DPI = 150  # Tesseract LSTM rende al meglio intorno ai 150 DPI
 PATH_FILE = Path("File")
 PATH_OUTPUT = Path("Output")
 MAX_HEIGHT = 20000
 RETRIES = 3
 RETRY_BASE_DELAY = 1.5
+OLLAMA_CONCURRENCY = 4  # richieste VL in parallelo verso il server Ollama
+OCR_WORKERS = NUM_THREADS  # processi Tesseract, uno per core fisico
+EMBED_BATCH = 64  # testi per chiamata a VectorIndex.add_texts
+CLI_INDEX_TYPES = ("flat", "sq8", "hnsw")  # tipi di indice esposti da riga di comando
 PATH_EXTRACT_IMAGE = Path("immagini_estratte")
+PATH_DB = "caratteristiche.db"  # tabella caratteristiche (non tracciato, vedi .gitignore)
+PATH_CACHE_DB = "cache.db"  # cache OCR/VL per hash del contenuto immagine
+PATH_EMB_CACHE = "emb_cache.npz"  # cache embedding per testo normalizzato
 # =================================
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 log = logging.getLogger("doc-analyzer")
 
+CREATE_CARATTERISTICHE = """
+CREATE TABLE IF NOT EXISTS caratteristiche (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  pdf TEXT,
+  nome TEXT,
+  descrizione TEXT,
+  pagina INTEGER
+)
+""".strip()
+INSERT_CARATTERISTICA = "INSERT INTO caratteristiche (pdf, nome, descrizione, pagina) VALUES (?, ?, ?, ?)"
+DELETE_CARATTERISTICHE_PDF = "DELETE FROM caratteristiche WHERE pdf = ?"
+
+_JSON_BLOCK = re.compile(r"\{.*\}", re.DOTALL)
+_SENT_SPLIT = re.compile(r"[.!?]\s+")
+
 PROMPT = """
 Agisci come un esperto di storia medievale italiana e analista di documenti accademici. Ti fornirò:
 - Un'immagine contenente una o più pagine di un documento storico medievale.
@@ -48,10 +80,7 @@ Il risultato deve essere **solo** JSON:
   "tags": ["castelli", "guerra", "fortificazioni", "XII secolo"]
 }
 """.strip()
-
-
-def set_tesseract(path: Optional[str] = None) -> None:
-    pytesseract.pytesseract.tesseract_cmd = path or DEFAULT_TESSERACT
+PROMPT_VERSION = hashlib.sha256(PROMPT.encode("utf-8")).hexdigest()[:12]
 
 
 def safe_json_loads(s: str, extra: Dict) -> Optional[Dict]:
@@ -59,61 +88,58 @@ def safe_json_loads(s: str, extra: Dict) -> Optional[Dict]:
     if cleaned.startswith("```") and cleaned.endswith("```"):
         cleaned = cleaned[3:-3].strip()
     try:
-        return (json.loads(cleaned) | extra)
+        return (orjson.loads(cleaned) | extra)
     except Exception:
-        m = re.search(r"\{.*\}", cleaned, flags=re.DOTALL)
+        m = _JSON_BLOCK.search(cleaned)
         if m:
             try:
-                return (json.loads(m.group(0)) | extra)
+                return (orjson.loads(m.group(0)) | extra)
             except Exception:
                 return None
     return None
 
 
-def ocr_image(img_path: Path, lang: str = OCR_LANG) -> str:
-    img = Image.open(img_path)
-    img = ImageOps.grayscale(img)
-    img = img.filter(ImageFilter.UnsharpMask(radius=1.2, percent=150, threshold=3))
-    return pytesseract.image_to_string(img, lang=lang)
-
-
-def extract_images_from_pdf(pdf_path: Path) -> Dict:
+def extract_images_from_pdf(doc: fitz.Document) -> Dict:
+    """
+    Estrae le immagini embedded da un documento già aperto.
+    Le immagini ripetute (stesso xref, es. loghi e intestazioni) vengono
+    decodificate e scritte una sola volta; le pagine successive ne riusano il path.
+    """
     PATH_EXTRACT_IMAGE.mkdir(parents=True, exist_ok=True)
     out = {"immagini": []}
-    try:
-        doc = fitz.open(str(pdf_path))
-        try:
-            for i in range(len(doc)):
-                page_num = i + 1
-                page = doc[i]
-                images_found = page.get_images(full=True)
-                if not images_found:
-                    log.info(f"Nessuna immagine embedded trovata nella pagina {page_num}")
-                    continue
-                for j, img in enumerate(images_found, start=1):
-                    try:
-                        xref = img[0]
-                        base = doc.extract_image(xref)
-                        ext = base["ext"]
-                        out_path = PATH_EXTRACT_IMAGE / f"pagina{page_num}_img{j}.{ext}"
-                        with open(out_path, "wb") as fh:
-                            fh.write(base["image"])
-                        out["immagini"].append({"pagina": page_num, "path": str(out_path)})
-                        log.info(f"Estratta immagine: {out_path}")
-                    except Exception as e:
-                        log.error(f"Errore estrazione img {j} pag {page_num}: {e}")
-        finally:
-            doc.close()
-    except Exception as e:
-        log.error(f"Errore apertura PDF {pdf_path}: {e}")
+    seen: Dict[int, Path] = {}
+    for i, page in enumerate(doc):
+        page_num = i + 1
+        images_found = page.get_images(full=True)
+        if not images_found:
+            log.info(f"Nessuna immagine embedded trovata nella pagina {page_num}")
+            continue
+        for j, img in enumerate(images_found, start=1):
+            try:
+                xref = img[0]
+                out_path = seen.get(xref)
+                if out_path is None:
+                    base = doc.extract_image(xref)
+                    ext = base["ext"]
+                    out_path = PATH_EXTRACT_IMAGE / f"pagina{page_num}_img{j}.{ext}"
+                    with open(out_path, "wb") as fh:
+                        fh.write(base["image"])
+                    seen[xref] = out_path
+                    log.info(f"Estratta immagine: {out_path}")
+                out["immagini"].append({"pagina": page_num, "path": str(out_path)})
+            except Exception as e:
+                log.error(f"Errore estrazione img {j} pag {page_num}: {e}")
     return out
 
 
-def call_ollama_with_retry(*, model: str, messages: List[Dict], images: Optional[List[str]] = None) -> str:
+async def call_ollama_with_retry(*, model: str, messages: List[Dict], images: Optional[List[str]] = None,
+                                 client: Optional[ollama.AsyncClient] = None) -> str:
     """
-    Chiamata Ollama con retry/backoff, ritorna il contenuto testuale.
+    Chiamata Ollama asincrona con retry/backoff, ritorna il contenuto testuale.
     images: lista di immagini base64 (se serve vision)
+    client: AsyncClient condiviso (se None ne crea uno)
     """
+    client = client or ollama.AsyncClient()
     payload = [{
         "role": "user",
         "content": messages[0]["content"],
@@ -122,28 +148,104 @@ def call_ollama_with_retry(*, model: str, messages: List[Dict], images: Optional
 
     for attempt in range(1, RETRIES + 1):
         try:
-            resp = ollama.chat(model=model, messages=payload)
+            resp = await client.chat(model=model, messages=payload)
             return resp["message"]["content"]
         except Exception as e:
             wait = RETRY_BASE_DELAY * (2 ** (attempt - 1))
             log.warning(f"Ollama fallita (tentativo {attempt}/{RETRIES}): {e}. Retry tra {wait:.1f}s")
-            time.sleep(wait)
+            await asyncio.sleep(wait)
     raise RuntimeError("Chiamata a Ollama fallita dopo i retry")
 
 
+async def gather_or_cancel(*coros) -> List:
+    """
+    Come asyncio.gather, ma al primo errore cancella gli altri task e
+    rilancia l'eccezione (equivalente di asyncio.TaskGroup per Python < 3.11).
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 class DocumentAnalyzer:
     CHOICES = {"1": "analyze_multi_page", "2": "analyze_single_page"}
 
     def __init__(self, pdf_path: Path, max_height: int = MAX_HEIGHT,
                  model_summary: str = DEFAULT_MODEL_VL,
-                 ocr_lang: str = OCR_LANG):
+                 ocr_lang: str = OCR_LANG,
+                 concurrency: int = OLLAMA_CONCURRENCY,
+                 use_cache: bool = True,
+                 index_type: str = "flat",
+                 dpi: int = DPI,
+                 ocr_dpi: int = OCR_DPI,
+                 dump: bool = False):
         self.pdf_path = Path(pdf_path)
         self.max_height = max_height
+        self.dpi = dpi
+        self.ocr_scale = min(1.0, ocr_dpi / dpi)
         self.model_summary = model_summary
         self.ocr_lang = ocr_lang
-        self.images = self.convert_pdf_to_images()
+        self.concurrency = max(1, concurrency)
+        self.index_type = index_type
+        self.cache = self._open_cache() if use_cache else None
+        self._cache_keys: Dict[str, str] = {}
+        self.doc = fitz.open(str(self.pdf_path))  # aperto una volta, condiviso da render ed estrazione
         self.output = {self.pdf_path.name: {}}
-        PATH_OUTPUT.mkdir(exist_ok=True)
+        self.dump = dump  # se True scrive i blocchi JPEG anche in PATH_OUTPUT
+        self._page_images: Dict[int, List[str]] = {}  # pagina -> immagini estratte
+
+    def close(self) -> None:
+        self.doc.close()
+        if self.cache is not None:
+            self.cache.close_connection()
+
+    @staticmethod
+    def _open_cache() -> DbManagement:
+        cache = DbManagement(PATH_CACHE_DB)
+        cache.execute_query(
+            "CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, ocr_text TEXT, vl_json TEXT)"
+        )
+        return cache
+
+    def _cache_key(self, name: str, img_bytes: bytes) -> str:
+        """
+        Chiave OCR = sha256(bytes immagine + parametri OCR).
+        """
+        h = hashlib.sha256(img_bytes)
+        h.update(f"|{self.ocr_lang}|{self.ocr_scale:.4f}".encode("utf-8"))
+        key = h.hexdigest()
+        self._cache_keys[name] = key
+        return key
+
+    def _vl_cache_key(self, ocr_key: str, prompt: str) -> str:
+        """
+        Chiave VL = sha256(chiave OCR + modello VL + prompt inviato), quindi
+        anche pagine coperte e testo OCR: stessa immagine su pagine diverse
+        non riusa la risposta.
+        """
+        h = hashlib.sha256(f"{ocr_key}|{self.model_summary}|".encode("utf-8"))
+        h.update(prompt.encode("utf-8"))
+        return h.hexdigest()
+
+    def _cache_get(self, key: str, column: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        rows = self.cache.execute_query(f"SELECT {column} FROM cache WHERE hash = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def _cache_put(self, key: str, column: str, value: str) -> None:
+        if self.cache is None:
+            return
+        self.cache.execute_query(
+            f"INSERT INTO cache (hash, {column}) VALUES (?, ?) "
+            f"ON CONFLICT(hash) DO UPDATE SET {column} = excluded.{column}",
+            (key, value)
+        )
 
     def clear_output_directory(self) -> None:
         if not PATH_OUTPUT.exists():
@@ -155,11 +257,22 @@ class DocumentAnalyzer:
             except Exception as e:
                 log.warning(f"Impossibile rimuovere {p}: {e}")
 
-    def convert_pdf_to_images(self) -> List[Image.Image]:
-        log.info(f"Converto PDF in immagini (DPI={DPI})...")
-        images = convert_from_path(str(self.pdf_path), dpi=DPI)
-        log.info(f"Pagine convertite: {len(images)}")
-        return images
+    def _render_pages(self) -> Iterator[Tuple[int, fitz.Pixmap]]:
+        """
+        Rasterizza le pagine con PyMuPDF, una alla volta (niente Poppler).
+        Ritorna (numero pagina, pixmap RGB).
+        """
+        log.info(f"Converto PDF in immagini (DPI={self.dpi})...")
+        matrix = fitz.Matrix(self.dpi / 72, self.dpi / 72)
+        for i, page in enumerate(self.doc, start=1):
+            yield i, page.get_pixmap(matrix=matrix, alpha=False)
+        log.info(f"Pagine convertite: {len(self.doc)}")
+
+    def _page_sizes(self) -> List[Tuple[int, int]]:
+        """Dimensioni in pixel delle pagine renderizzate, senza renderizzarle."""
+        matrix = fitz.Matrix(self.dpi / 72, self.dpi / 72)
+        rects = [(page.rect * matrix).irect for page in self.doc]
+        return [(r.width, r.height) for r in rects]
 
     def start_analyzer(self, choice: str):
         method_name = self.CHOICES.get(choice)
@@ -173,190 +286,313 @@ class DocumentAnalyzer:
         Unisce le pagine in blocchi verticali (rispettando MAX_HEIGHT).
         Registra per ogni immagine di output il vettore di pagine coperte.
         """
-        self.clear_output_directory()
-        output_prefix = PATH_OUTPUT / "merged_image"
+        return self._process_output_images(self._iter_multi_page_blocks())
+
+    def _iter_multi_page_blocks(self) -> Iterator[Tuple[str, bytes, List[int]]]:
+        if self.dump:
+            self.clear_output_directory()
 
-        widths = [img.width for img in self.images]
-        max_width = max(widths)
+        max_width = max(w for w, _ in self._page_sizes())
 
         y = 0
         idx = 1
         pages_in_block = []
-        merged = Image.new("RGB", (max_width, self.max_height), color="white")
+        # un solo buffer bianco riusato per tutti i blocchi
+        buf = np.full((self.max_height, max_width, 3), 255, dtype=np.uint8)
 
-        for page_idx, img in enumerate(self.images, start=1):
-            h = img.height
+        for page_idx, pix in self._render_pages():
+            h = pix.height
             if y + h > self.max_height and pages_in_block:
-                out_path = f"{output_prefix}_{idx}.jpg"
-                merged.save(out_path, "JPEG", quality=95)
-                self.output[self.pdf_path.name][Path(out_path).name] = {
-                    "pages": pages_in_block[:],
-                    "images": []
-                }
+                yield self._make_block(f"merged_image_{idx}.jpg", self._pil_to_jpeg_bytes(Image.fromarray(buf)),
+                                       pages_in_block[:])
                 idx += 1
-                merged = Image.new("RGB", (max_width, self.max_height), color="white")
+                buf[...] = 255
                 y = 0
                 pages_in_block = []
 
-            merged.paste(img, (0, y))
+            # vista senza copie su pix.samples_mv: valida solo finché pix è vivo,
+            # quindi va copiata in buf prima di rilasciare il pixmap
+            arr = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            arr = arr[:self.max_height - y, :max_width]
+            buf[y:y + arr.shape[0], :arr.shape[1]] = arr
+            del arr, pix  # la pagina non serve più: memoria O(1) rispetto al numero di pagine
             y += h
             pages_in_block.append(page_idx)
 
         if pages_in_block:
-            out_path = f"{output_prefix}_{idx}.jpg"
-            merged.save(out_path, "JPEG", quality=95)
-            self.output[self.pdf_path.name][Path(out_path).name] = {
-                "pages": pages_in_block[:]
-            }
-
-        return self._process_output_images()
+            yield self._make_block(f"merged_image_{idx}.jpg", self._pil_to_jpeg_bytes(Image.fromarray(buf)),
+                                   pages_in_block[:])
 
     # ---------- Modalità 2: pagina per pagina ----------
     def analyze_single_page(self):
-        self.clear_output_directory()
-        for i, img in enumerate(self.images, start=1):
-            out = PATH_OUTPUT / f"page_{i:04d}.jpg"
-            out.write_bytes(self._pil_to_jpeg_bytes(img))
-            # registra pagine e images per ogni file pagina
-            self.output[self.pdf_path.name][out.name] = {"pages": [i], "images": []}
-        return self._process_output_images()
+        return self._process_output_images(self._iter_single_page_blocks())
+
+    def _iter_single_page_blocks(self) -> Iterator[Tuple[str, bytes, List[int]]]:
+        if self.dump:
+            self.clear_output_directory()
+        for i, pix in self._render_pages():
+            yield self._make_block(f"page_{i:04d}.jpg", pix.tobytes("jpg", jpg_quality=95), [i])
+            del pix
+
+    def _make_block(self, name: str, data: bytes, pages: List[int]) -> Tuple[str, bytes, List[int]]:
+        """Blocco JPEG in memoria (scritto su disco solo con --dump)."""
+        if self.dump:
+            (PATH_OUTPUT / name).write_bytes(data)
+        return name, data, pages
+
+    def _register_block(self, name: str, pages: List[int]) -> None:
+        """Registra pagine e immagini estratte del blocco nell'output."""
+        images = list(dict.fromkeys(p for page in pages for p in self._page_images.get(page, [])))
+        self.output[self.pdf_path.name][name] = {"pages": pages, "images": images}
 
     @staticmethod
     def _pil_to_jpeg_bytes(img: Image.Image) -> bytes:
-        from io import BytesIO
         buf = BytesIO()
-        img.save(buf, format="JPEG", quality=95)
+        img.save(buf, format="JPEG", quality=95, optimize=False)
         return buf.getvalue()
 
-    def _generate_sql_from_summary(self, summary_text: str, tags: List[str], pages: List[int]) -> str:
+    def _generate_sql_from_summary(self, summary_text: str, tags: List[str],
+                                   pages: List[int]) -> List[Tuple]:
         """
-        Crea SQL deterministico a partire da riassunto+tag.
+        Crea righe deterministiche a partire da riassunto+tag.
         - Prende i primi N tag come 'nome'.
         - Usa frasi chiave dal riassunto come 'descrizione'.
         - Collega alle pagine fornite.
+        Ritorna righe (nome, descrizione, pagina): il pdf viene anteposto
+        in _save_caratteristiche prima di INSERT_CARATTERISTICA.
         """
         N = min(10, len(tags))
         chosen = tags[:N] or ["generico"]
-        sentences = [s.strip() for s in re.split(r'[.!?]\s+', summary_text) if len(s.strip()) > 0]
+        sentences = [t for t in (s.strip() for s in _SENT_SPLIT.split(summary_text)) if t]
         snippets = (sentences[:N] or ["caratteristica estratta dal riassunto"])
 
-        page_list = pages or [None] * N
-
-        lines = [
-            "CREATE TABLE IF NOT EXISTS caratteristiche (",
-            "  id INTEGER PRIMARY KEY AUTOINCREMENT,",
-            "  nome TEXT,",
-            "  descrizione TEXT,",
-            "  pagina INTEGER",
-            ");"
-        ]
-        for i, nome in enumerate(chosen):
-            desc = (snippets[i] if i < len(snippets) else snippets[-1])[:400]
-            page = page_list[i] if i < len(page_list) else None
-            lines.append(
-                "INSERT INTO caratteristiche (nome, descrizione, pagina) "
-                f"VALUES ({json.dumps(nome)}, {json.dumps(desc)}, {'NULL' if page is None else page});"
-            )
-        return "\n".join(lines)
-
-    def _summarize_with_vl(self, img_path: Path) -> Optional[Dict]:
-        text = ocr_image(img_path, lang=self.ocr_lang)
-        self.output[self.pdf_path.name].setdefault(img_path.name, {}).setdefault("ocr_text", text)
-        with open(img_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("utf-8")
-
-        pages = self.output[self.pdf_path.name].get(img_path.name, {}).get("pages", [])
+        # colonne precalcolate e allineate a chosen: descrizioni oltre le frasi
+        # disponibili ripetono l'ultima, pagine mancanti diventano NULL
+        n = len(chosen)
+        descs = [d[:400] for d in snippets[:n]]
+        descs += [descs[-1]] * (n - len(descs))
+        page_list = list((pages or [])[:n])
+        page_list += [None] * (n - len(page_list))
+        rows = list(zip(chosen, descs, page_list))
+        return rows
+
+    async def _ocr_one(self, name: str, img_bytes: bytes, executor: ProcessPoolExecutor) -> None:
+        """
+        OCR di un blocco: prima la cache, altrimenti Tesseract nel pool di processi.
+        Il testo viene salvato in output[...]["ocr_text"] e riusato dal VL.
+        """
+        entry = self.output[self.pdf_path.name].setdefault(name, {})
+        key = self._cache_key(name, img_bytes)
+        text = self._cache_get(key, "ocr_text")
+        if text is None:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(executor, ocr_image_bytes, img_bytes, self.ocr_lang, self.ocr_scale)
+            self._cache_put(key, "ocr_text", text)
+        else:
+            log.info(f"OCR in cache per {name}")
+        entry["ocr_text"] = text
+
+    async def _summarize_with_vl(self, name: str, img_bytes: bytes, pages: List[int],
+                                 client: ollama.AsyncClient) -> Optional[Dict]:
+        entry = self.output[self.pdf_path.name].setdefault(name, {})
+        ocr_key = self._cache_keys.get(name) or self._cache_key(name, img_bytes)
+        text = entry.get("ocr_text")
+        if text is None:
+            # OCR fallito nel pool: si prosegue col solo VL, senza rifare Tesseract sull'event loop
+            log.warning(f"Nessun testo OCR per {name}: invio solo l'immagine al VL")
+            text = ""
+
         prompt = (
                 PROMPT + f"\n\nPagine coperte dal blocco: {pages}\n"
                          "Testo estratto OCR:\n" + text
         )
-        content = call_ollama_with_retry(
+        key = self._vl_cache_key(ocr_key, prompt)
+        content = self._cache_get(key, "vl_json")
+        if content is not None:
+            log.info(f"Risposta VL in cache per {name}")
+            return safe_json_loads(content, {"pages": pages})
+
+        b64 = base64.b64encode(img_bytes).decode("ascii")
+        content = await call_ollama_with_retry(
             model=self.model_summary,
             messages=[{"role": "user", "content": prompt}],
-            images=[b64]
+            images=[b64],
+            client=client
         )
         data = safe_json_loads(content, {"pages": pages})
+        if data is not None:  # risposte non JSON non vanno in cache: al prossimo giro si riprova
+            self._cache_put(key, "vl_json", content)
         return data
 
-    def _process_output_images(self) -> Dict:
-        jpgs = sorted(PATH_OUTPUT.glob("*.jpg"))
+    def _store_summary(self, name: str, resp: Optional[Dict]) -> List[Tuple]:
+        """Registra riassunto/tag nell'output e ritorna le righe caratteristiche."""
+        if not resp:
+            log.warning(f"Risposta non JSON per {name}")
+            return []
+
+        summary = resp.get("riassunto", "").strip()
+        tags = resp.get("tags", [])
+        pages = resp.get("pages", [])
+        rows = self._generate_sql_from_summary(summary, tags, pages)
+
+        self.output[self.pdf_path.name][name] = {
+            **self.output[self.pdf_path.name].get(name, {}),
+            "riassunto": summary,
+            "tags": tags,
+            "caratteristiche": rows
+        }
+        return rows
+
+    async def _pipeline(self, blocks: Iterator[Tuple[str, bytes, List[int]]], vec: "VectorIndex") -> List[Tuple]:
+        """
+        Pipeline producer/consumer: render (thread) -> OCR (processi, CPU)
+        -> VL (async, Ollama) -> embedding (thread, batch da EMBED_BATCH).
+        Il render usa un solo thread dedicato per tutte le chiamate fitz.
+        I blocchi arrivano da un generatore, quindi il render si sovrappone
+        a OCR/VL e in memoria restano solo i blocchi in lavorazione. Le fasi
+        lavorano in parallelo su blocchi diversi; gli errori sul singolo blocco vengono
+        loggati e il blocco prosegue comunque verso l'embedding, mentre un
+        errore di una fase cancella le altre e viene rilanciato.
+        Ritorna tutte le righe caratteristiche.
+        """
+        q_vl: asyncio.Queue = asyncio.Queue(maxsize=2 * self.concurrency)
+        q_embed: asyncio.Queue = asyncio.Queue()
+        client = ollama.AsyncClient()
+        all_rows: List[Tuple] = []
+
+        async def ocr_stage(executor: ProcessPoolExecutor, render: ThreadPoolExecutor) -> None:
+            # blocchi renderizzati ma non ancora passati al VL: limita la memoria
+            in_flight = asyncio.Semaphore(2 * OCR_WORKERS)
+            tasks: set = set()
+            n_blocks = 0
+            loop = asyncio.get_running_loop()
+
+            async def one(block: Tuple[str, bytes, List[int]]) -> None:
+                try:
+                    try:
+                        await self._ocr_one(block[0], block[1], executor)
+                    except Exception as e:
+                        log.error(f"Errore OCR su {block[0]}: {e}")
+                    await q_vl.put(block)
+                finally:
+                    in_flight.release()
 
-        for img_path in jpgs:
             try:
-                resp = self._summarize_with_vl(img_path)
-                if not resp:
-                    log.warning(f"Risposta non JSON per {img_path.name}")
+                while True:
+                    await in_flight.acquire()
+                    # il render (PyMuPDF + JPEG) gira fuori dall'event loop, sempre
+                    # sullo stesso thread: PyMuPDF non supporta l'uso da più thread
+                    block = await loop.run_in_executor(render, next, blocks, None)
+                    if block is None:
+                        break
+                    self._register_block(block[0], block[2])
+                    n_blocks += 1
+                    task = asyncio.create_task(one(block))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            log.info(f"Render e OCR completati su {n_blocks} immagini")
+            for _ in range(self.concurrency):
+                await q_vl.put(None)
+
+        async def vl_worker() -> None:
+            while (block := await q_vl.get()) is not None:
+                name, img_bytes, pages = block
+                try:
+                    resp = await self._summarize_with_vl(name, img_bytes, pages, client)
+                    all_rows.extend(self._store_summary(name, resp))
+                except Exception as e:
+                    log.error(f"Errore su {name}: {e}")
+                await q_embed.put(name)
+
+        async def vl_stage() -> None:
+            await asyncio.gather(*[vl_worker() for _ in range(self.concurrency)])
+            await q_embed.put(None)
+
+        async def embed_stage() -> None:
+            texts, metas = [], []
+            while (fname := await q_embed.get()) is not None:
+                entry = self.output[self.pdf_path.name][fname]
+                emb_text = self._embedding_text_from_entry(entry)
+                if not emb_text:
                     continue
+                texts.append(emb_text)
+                metas.append({
+                    "file": fname,
+                    "pages": entry.get("pages", []),
+                    "tags": entry.get("tags", []),
+                    "images": entry.get("images", []),
+                    "pdf": self.pdf_path.name
+                })
+                # sq8/ivfpq si addestrano sul primo add_texts: finché non sono
+                # addestrati si accumula tutto il corpus invece di batch da EMBED_BATCH
+                if len(texts) >= EMBED_BATCH and not vec.needs_training:
+                    await asyncio.to_thread(vec.add_texts, texts, metas)
+                    texts, metas = [], []
+            if texts:
+                await asyncio.to_thread(vec.add_texts, texts, metas)
+
+        log.info(f"Pipeline: OCR su {OCR_WORKERS} processi, "
+                 f"{self.concurrency} chiamate VL in parallelo")
+        executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=init_ocr_worker,
+                                       initargs=(pytesseract.pytesseract.tesseract_cmd,))
+        render = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        try:
+            await gather_or_cancel(ocr_stage(executor, render), vl_stage(), embed_stage())
+        except BaseException:
+            # non aspettare gli OCR già in coda: l'errore deve emergere subito
+            executor.shutdown(wait=False, cancel_futures=True)
+            render.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        render.shutdown()
+        return all_rows
+
+    def _process_output_images(self, blocks: Iterator[Tuple[str, bytes, List[int]]]) -> Dict:
+        from embedding import VectorIndex
+
+        # prima del render, così ogni blocco registrato ha già le sue immagini
+        self._extract_images_from_pdf()
+        vec = VectorIndex(index_type=self.index_type,
+                          emb_cache_path=PATH_EMB_CACHE if self.cache is not None else None)
 
-                summary = resp.get("riassunto", "").strip()
-                tags = resp.get("tags", [])
-                pages = resp.get("pages", [])
-                sql_query = self._generate_sql_from_summary(summary, tags, pages)
-
-                self.output[self.pdf_path.name][img_path.name] = {
-                    **self.output[self.pdf_path.name].get(img_path.name, {}),
-                    "riassunto": summary,
-                    "tags": tags,
-                    "sql": sql_query
-                }
+        all_rows = asyncio.run(self._pipeline(blocks, vec))
 
-            except Exception as e:
-                log.error(f"Errore su {img_path.name}: {e}")
-        self._extract_images_from_pdf()
-        vec = VectorIndex()
-        texts, metas = [], []
-
-        for fname, entry in self.output[self.pdf_path.name].items():
-            emb_text = self._embedding_text_from_entry(entry)
-            if not emb_text:
-                continue
-            texts.append(emb_text)
-            metas.append({
-                "file": fname,
-                "pages": entry.get("pages", []),
-                "tags": entry.get("tags", []),
-                "images": entry.get("images", []),
-                "pdf": self.pdf_path.name
-            })
-
-        vec.add_texts(texts, metas)
+        self._save_caratteristiche(self.pdf_path.name, all_rows)
         vec.save("index.faiss", "index_meta.json")
         return {self.pdf_path.name: self.output[self.pdf_path.name]}
 
+    @staticmethod
+    def _save_caratteristiche(pdf: str, rows: List[Tuple]) -> None:
+        """
+        Sostituisce le righe del PDF in un'unica transazione: rilanci non
+        duplicano e un rilancio senza righe cancella quelle precedenti.
+        """
+        db = DbManagement(PATH_DB)
+        try:
+            db.execute_query(CREATE_CARATTERISTICHE)
+            if "pdf" not in db.columns("caratteristiche"):  # tabelle create prima della colonna pdf
+                db.execute_query("ALTER TABLE caratteristiche ADD COLUMN pdf TEXT")
+            db.executemany(INSERT_CARATTERISTICA, [(pdf, *r) for r in rows],
+                           before=(DELETE_CARATTERISTICHE_PDF, (pdf,)))
+            log.info(f"Salvate {len(rows)} caratteristiche in {PATH_DB}")
+        except Exception as e:
+            log.error(f"Errore salvataggio caratteristiche: {e}")
+        finally:
+            db.close_connection()
+
     def _extract_images_from_pdf(self) -> None:
-        PATH_EXTRACT_IMAGE.mkdir(parents=True, exist_ok=True)
         try:
-            doc = fitz.open(str(self.pdf_path))
-            try:
-                for i in range(len(doc)):
-                    page_num = i + 1
-                    page = doc[i]
-                    images_found = page.get_images(full=True)
-                    if not images_found:
-                        log.info(f"Nessuna immagine embedded trovata nella pagina {page_num}")
-                        continue
-
-                    for j, img in enumerate(images_found, start=1):
-                        try:
-                            xref = img[0]
-                            base = doc.extract_image(xref)
-                            ext = base["ext"]
-                            out_path = PATH_EXTRACT_IMAGE / f"pagina{page_num}_img{j}.{ext}"
-                            with open(out_path, "wb") as fh:
-                                fh.write(base["image"])
-
-                            for _, entry in self.output[self.pdf_path.name].items():
-                                pages = entry.get("pages", [])
-                                if page_num in pages:
-                                    entry.setdefault("images", []).append(str(out_path))
-
-                            log.info(f"Estratta immagine: {out_path}")
-                        except Exception as e:
-                            log.error(f"Errore estrazione img {j} pag {page_num}: {e}")
-            finally:
-                doc.close()
+            found = extract_images_from_pdf(self.doc)
         except Exception as e:
-            log.error(f"Errore apertura PDF {self.pdf_path}: {e}")
+            log.error(f"Errore estrazione immagini da {self.pdf_path}: {e}")
+            return
+        for item in found["immagini"]:
+            self._page_images.setdefault(item["pagina"], []).append(item["path"])
 
     def _embedding_text_from_entry(self, entry: Dict) -> str:
         parts = []
@@ -378,20 +614,40 @@ def main():
     parser.add_argument("--tesseract", type=str, default=DEFAULT_TESSERACT)
     parser.add_argument("--model-vl", type=str, default=DEFAULT_MODEL_VL)
     parser.add_argument("--ocr-lang", type=str, default=OCR_LANG)
-    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--dpi", type=int, default=DPI)
+    parser.add_argument("--ocr-dpi", type=int, default=OCR_DPI,
+                        help="DPI a cui ridurre le pagine prima dell'OCR")
+    parser.add_argument("--concurrency", type=int, default=OLLAMA_CONCURRENCY,
+                        help="numero massimo di chiamate VL in parallelo")
+    parser.add_argument("--dump", action="store_true",
+                        help=f"salva anche i blocchi JPEG in {PATH_OUTPUT}")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="disabilita la cache OCR/VL su disco")
+    # ivfpq resta solo via API (VectorIndex.train): un singolo PDF non raggiunge i vettori minimi
+    parser.add_argument("--index-type", choices=CLI_INDEX_TYPES, default="flat",
+                        help="indice FAISS: flat (esatto), sq8 (esatto int8), hnsw (medi)")
     args = parser.parse_args()
     set_tesseract(args.tesseract)
     analyzer = DocumentAnalyzer(
         pdf_path=Path(args.pdf),
         model_summary=args.model_vl,
-        ocr_lang=args.ocr_lang
+        ocr_lang=args.ocr_lang,
+        dpi=args.dpi,
+        ocr_dpi=args.ocr_dpi,
+        dump=args.dump,
+        concurrency=args.concurrency,
+        use_cache=not args.no_cache,
+        index_type=args.index_type
     )
 
     log.info("Scegli il metodo di analisi: 1=merge multi-pagina, 2=pagina per pagina")
-    results = analyzer.start_analyzer(args.mode)
-    print(json.dumps(results, ensure_ascii=False, indent=2))
-    with open("prova.json", "w") as outfile:
-        json.dump(results, outfile)
+    try:
+        results = analyzer.start_analyzer(args.mode)
+    finally:
+        analyzer.close()
+    print(orjson.dumps(results, option=orjson.OPT_INDENT_2).decode("utf-8"))
+    with open("prova.json", "wb") as outfile:
+        outfile.write(orjson.dumps(results))
 
 
 if __name__ == "__main__":
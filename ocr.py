@@ -0,0 +1,54 @@
+import os
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+import pytesseract
+from PIL import Image, ImageOps, ImageFilter
+
+# Modulo leggero (niente torch/faiss): è l'unico importato dai processi OCR.
+
+DEFAULT_TESSERACT = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+OCR_LANG = "eng+ita"  # personalizzabile da CLI
+TESSERACT_CONFIG = "--oem 1 --psm 3"
+
+
+def set_tesseract(path: Optional[str] = None) -> None:
+    pytesseract.pytesseract.tesseract_cmd = path or DEFAULT_TESSERACT
+
+
+def init_ocr_worker(path: Optional[str] = None) -> None:
+    """
+    Initializer dei processi OCR: un solo thread OpenMP per Tesseract,
+    il parallelismo lo dà il pool (come raccomandato da Tesseract).
+    """
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    set_tesseract(path)
+
+
+def otsu_threshold(arr: np.ndarray) -> int:
+    """Soglia di Otsu su immagine in scala di grigi uint8."""
+    hist = np.bincount(arr.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * levels)
+    mu0 = m0 / np.maximum(w0, 1)
+    mu1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    between = w0 * w1 * (mu0 - mu1) ** 2
+    return int(np.argmax(between))
+
+
+def ocr_image_bytes(data: bytes, lang: str = OCR_LANG, scale: float = 1.0) -> str:
+    """
+    OCR con preprocessing: scala di grigi, riduzione a `scale` (es. OCR_DPI/DPI),
+    sharpening e binarizzazione di Otsu.
+    """
+    img = Image.open(BytesIO(data))
+    img = ImageOps.grayscale(img)
+    if scale < 1.0:
+        img.thumbnail((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    img = img.filter(ImageFilter.UnsharpMask(radius=1.2, percent=150, threshold=3))
+    arr = np.asarray(img)
+    img = Image.fromarray((arr > otsu_threshold(arr)).astype(np.uint8) * 255)
+    return pytesseract.image_to_string(img, lang=lang, config=TESSERACT_CONFIG)
@@ -1,11 +1,24 @@
+from typing import Dict, List, Optional, Union
+
 from embedding import VectorIndex
 
+_index: Optional[VectorIndex] = None
+
+
+def get_index() -> VectorIndex:
+    """Carica indice e modello una sola volta e li riusa tra le chiamate."""
+    global _index
+    if _index is None:
+        _index = VectorIndex()
+        _index.load("index.faiss", "index_meta.json")
+    return _index
+
 
-def ask(query: str, top_k: int = 5):
-    v = VectorIndex()
-    v.load("index.faiss", "index_meta.json")
-    hits = v.search(query, k=top_k)
-    return hits
+def ask(query: Union[str, List[str]], top_k: int = 5) -> Union[List[Dict], List[List[Dict]]]:
+    v = get_index()
+    if isinstance(query, str):
+        return v.search(query, k=top_k)
+    return v.search_batch(query, k=top_k)
 
 if __name__ == '__main__':
-    print(ask("difese dei castelli in puglia nel XII secolo", 3))
\ No newline at end of file
+    print(ask("difese dei castelli in puglia nel XII secolo", 3))
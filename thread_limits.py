@@ -0,0 +1,10 @@
+import os
+
+# Thread pool di FAISS, PyTorch e BLAS limitati ai core fisici (stima: cpu_count // 2)
+# per evitare oversubscription tra encode e add/search.
+# OpenBLAS/MKL/OpenMP leggono queste variabili al caricamento della libreria:
+# questo modulo va importato prima di numpy, faiss e torch (vedi main.py, embedding.py).
+# Per cambiarlo: esportare OMP_NUM_THREADS prima di avviare.
+NUM_THREADS = int(os.environ.get("OMP_NUM_THREADS") or (os.cpu_count() or 2) // 2 or 1)
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, str(NUM_THREADS))